@@ -12,7 +12,7 @@ class NpyDataset(torch.utils.data.Dataset):
         self._single_shape = self._data[0,0].shape
         # make sure we have a colour channel axis, even if it is only of length 1
         if len(self._single_shape) == 2: self._single_shape = (1, *self._single_shape)
-        self._blank_mask = torch.ones(self._single_shape)
+        self._blank_mask = torch.ones(self._single_shape, dtype=torch.bool)
         round_index = lambda index: round(index*len(self._data)) if type(index) is not int else index
         self._indices = np.arange(round_index(start_index), round_index(stop_index))
     def __getitem__(self, index: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -31,6 +31,73 @@ class NpyDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self._indices)
 
+def make_dataloader(dataset: torch.utils.data.Dataset, batch_size: int, shuffle: bool = True, num_workers: int = None, drop_last: bool = True) -> torch.utils.data.DataLoader:
+    """Build a dataloader configured for fast training: pinned memory, persistent workers and a modest prefetch depth
+
+    num_workers: the number of worker processes; defaults to half the available CPUs
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1)//2)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=True,
+        drop_last=drop_last,
+        # keep workers alive between epochs rather than respawning them
+        persistent_workers=num_workers > 0,
+        # a deeper prefetch only adds pinned memory once the workers keep up
+        prefetch_factor=2 if num_workers > 0 else None
+    )
+
+class CudaPrefetcher:
+    """Wrap a dataloader, copying each batch to the device on a side stream one iteration ahead"""
+    def __init__(self, dataloader: torch.utils.data.DataLoader, device: str):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        # only CUDA devices can overlap copies with compute; otherwise just move each batch in turn
+        self._stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self._iterator = None
+        self._next_batch = None
+    def __len__(self):
+        return len(self.dataloader)
+    def __iter__(self):
+        self._iterator = iter(self.dataloader)
+        self._preload()
+        return self
+    def __next__(self) -> tuple:
+        if self._next_batch is None:
+            raise StopIteration
+        batch = self._next_batch
+        if self._stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            # make sure the copies have finished before the batch is used
+            current_stream.wait_stream(self._stream)
+            # stop the caching allocator from reusing this memory while the current stream still needs it
+            for item in batch:
+                if isinstance(item, torch.Tensor):
+                    item.record_stream(current_stream)
+        # start copying the following batch
+        self._preload()
+        return batch
+    def _preload(self) -> None:
+        try:
+            batch = next(self._iterator)
+        except StopIteration:
+            self._next_batch = None
+            return
+        if self._stream is None:
+            self._next_batch = tuple(self._to_device(item) for item in batch)
+        else:
+            with torch.cuda.stream(self._stream):
+                self._next_batch = tuple(self._to_device(item) for item in batch)
+    def _to_device(self, item):
+        # move images and masks; integer tensors such as dataset indices are only read on the host, so leave them there
+        if isinstance(item, torch.Tensor) and (item.is_floating_point() or item.dtype == torch.bool):
+            return item.to(self.device, non_blocking=True)
+        return item
+
 class Saver:
     def __init__(self, process_fn: Callable[[torch.Tensor], np.ndarray] = lambda tensor: tensor.cpu().numpy()):
         self.process_fn = process_fn
@@ -60,7 +60,7 @@ class InferenceFramework:
             )
         )
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def infer_all_data(self):
         """Sample from the neural network over a single iteration of the inference dataloader
         """
@@ -69,7 +69,7 @@ class InferenceFramework:
         for i, data in enumerate(tqdm.tqdm(self.inference_dataloader)):
             gt_image_batch, cond_image_batch, mask, actual_index = data
             # infer the image
-            predicted_gt_image_batch = self.infer_one_batch(cond_image_batch.to(self.device), mask.to(self.device))
+            predicted_gt_image_batch = self.infer_one_batch(cond_image_batch.to(self.device, non_blocking=True), mask.to(self.device, non_blocking=True))
             
             # log the each visual from the batch
             for j in range(len(predicted_gt_image_batch)):
@@ -87,7 +87,7 @@ class InferenceFramework:
                     )
         
   
-    @torch.no_grad()
+    @torch.inference_mode()
     def infer_one_batch(self, cond_image_batch: torch.Tensor, mask: torch.BoolTensor) -> torch.Tensor:
         """Sample from the neural network over a single batch of images, and run metrics
 
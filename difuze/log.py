@@ -1,5 +1,8 @@
 import torch
 import os
+import atexit
+import threading
+import concurrent.futures
 
 from datetime import datetime
 from socket import gethostname
@@ -14,7 +17,8 @@ class DataLogger:
             use_tensorboard: bool = False,
             timestamp_format: str = '%Y-%m-%d_%H-%M-%S',
             visual_function: Callable[[torch.Tensor], torch.Tensor] = lambda tensor: tensor.cpu(),
-            save_functions: list[data.Saver] = []
+            save_functions: list[data.Saver] = [],
+            io_workers: int = 2
         ):
         ## establish base path
         timestamp = datetime.now().strftime(timestamp_format)
@@ -40,6 +44,16 @@ class DataLogger:
         self.timestamp_format = timestamp_format
         self.visual_function = visual_function
         self.save_functions = save_functions
+
+        ## keep the log file open between messages; it is opened on the first message, once the base directory exists
+        self._log_file = None
+        # messages may also come from the background IO threads
+        self._log_lock = threading.Lock()
+
+        ## encode and write output tensors in the background, so that training is not held up by IO
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=io_workers)
+        self._closed = False
+        atexit.register(self.close)
     
     def message(self, lines: str, also_print: bool = True) -> None:
         """Add a line to the log file
@@ -48,8 +62,9 @@ class DataLogger:
         date_time: whether the date and time should be included in the log message
         """
 
-        # make base directory if needed
-        os.makedirs(self.base_directory, exist_ok=True)
+        # make base directory if needed, before the log file is first opened
+        if self._log_file is None:
+            os.makedirs(self.base_directory, exist_ok=True)
 
         # split lines
         lines_list = lines.split('\n')
@@ -58,21 +73,22 @@ class DataLogger:
         time_stamp = datetime.now().strftime(self.timestamp_format)
 
         # write the first line with a timestamp
-        self._write_line(time_stamp+lines_list[0], self.log_path, also_print)
+        self._write_line(time_stamp+lines_list[0], also_print)
 
         # write the remaining lines without timestamps
         for line in lines_list[1:]:
-            self._write_line(' '*(len(time_stamp)-3)+'=> '+line, self.log_path, also_print)
+            self._write_line(' '*(len(time_stamp)-3)+'=> '+line, also_print)
 
         
-    @staticmethod
-    def _write_line(line: str, log_path: str, also_print: bool) -> None:
+    def _write_line(self, line: str, also_print: bool) -> None:
         # print the output if desired
         if also_print:
             print(line)
-        # write the output to the logfile
-        with open(log_path, 'a') as log_file:
-            log_file.write(line+'\n')
+        # write the output to the logfile, which is line buffered so each line still reaches the file immediately
+        with self._log_lock:
+            if self._log_file is None:
+                self._log_file = open(self.log_path, 'a', buffering=1)
+            self._log_file.write(line+'\n')
     
     def scalar(
             self,
@@ -102,9 +118,28 @@ class DataLogger:
             save_locally: bool = True,
             filename_format: str = '{series}{index:0>8d}_{tag}'
         ) -> None:
-        """Add an output tensor to Tensorboard and/or save it locally
+        """Add an output tensor to Tensorboard and/or save it locally, in the background
         """
 
+        # copy to the host now, so that the device memory can be released while the output is written
+        tensor = tensor.detach().cpu()
+        # once closed there is no background pool, so write the output directly
+        if self._closed:
+            self._write_tensor(series_name, tag, tensor, index, add_to_tensorboard, save_locally, filename_format)
+            return
+        future = self._io_pool.submit(self._write_tensor, series_name, tag, tensor, index, add_to_tensorboard, save_locally, filename_format)
+        future.add_done_callback(self._report_io_error)
+
+    def _write_tensor(
+            self,
+            series_name: str,
+            tag: str,
+            tensor: torch.Tensor,
+            index: int,
+            add_to_tensorboard: bool,
+            save_locally: bool,
+            filename_format: str
+        ) -> None:
         if self.summary_writer is not None and add_to_tensorboard:
             self.summary_writer.add_image(series_name, self.visual_function(tensor), index)
         
@@ -136,3 +171,25 @@ class DataLogger:
         name = 'model_{}{}'.format(epoch_number, _best)
         # save model to file
         torch.save(state_dict, os.path.join(self.model_base_directory, name))
+
+    def _report_io_error(self, future: concurrent.futures.Future) -> None:
+        # exceptions raised in the background would otherwise be silently discarded
+        if future.exception() is not None:
+            self.message('WARNING: failed to write output tensor: {!r}'.format(future.exception()), also_print=True)
+
+    def close(self) -> None:
+        """Wait for all pending output to be written, and close the log file
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        # the logger no longer needs to be kept alive until the interpreter exits
+        atexit.unregister(self.close)
+        self._io_pool.shutdown(wait=True)
+        if self.summary_writer is not None:
+            self.summary_writer.flush()
+        with self._log_lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
@@ -1,6 +1,7 @@
 import torch
 
 class Metric:
+    # may return either a float or a scalar tensor; returning a tensor on the device avoids a sync per image
     def __call__(self, predicted_gt_image: torch.Tensor, gt_image: torch.Tensor) -> float:
         raise AttributeError('Must define how to call metric!')
     @property
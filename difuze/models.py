@@ -6,11 +6,11 @@ from . import support
 
 # define a placeholder class for diffusion models, demonstrating the necessity of a refinement_step method
 class Diffusion(torch.nn.Module):
-    @torch.no_grad()
+    @torch.inference_mode()
     def refinement_step(self, predicted_gt_image_batch_t, cond_image_batch, alpha_t, gamma_t):
         raise AttributeError('Must define a refinement step!')
     
-    @torch.no_grad()
+    @torch.inference_mode()
     def infer_one_batch(self, cond_image_batch: torch.Tensor, mask: torch.BoolTensor, inference_noise_schedule: support.NoiseSchedule) -> torch.Tensor:
         """Sample from the neural network over a single batch of images
 
@@ -18,20 +18,29 @@ class Diffusion(torch.nn.Module):
         mask: a boolean array of pixels to ignore in predictions (NOT YET IMPLEMENTED)
         """
 
+        # fetch the noise schedule from the device, rather than copying each value there on every step
+        alphas, gammas = inference_noise_schedule.device_tensors(cond_image_batch.device)
+        # convert the mask once, so that each masking operation is a single select
+        mask_b = mask.to(torch.bool)
         # start with a noise field, inserting the cond_image_batch where the mask is present
-        predicted_gt_image_batch = torch.randn_like(cond_image_batch)*mask + cond_image_batch*(1-mask)
+        predicted_gt_image_batch = torch.where(mask_b, torch.randn_like(cond_image_batch), cond_image_batch)
         # iteratively apply the refinement step to denoise and renoise the image
         # note: t runs from T to 1
         for i in tqdm.tqdm(range(len(inference_noise_schedule))):
             # calculate the current t value from i
             t = len(inference_noise_schedule) - (i+1)
             # actually predict an image, and apply the mask
-            predicted_gt_image_batch = self.refinement_step(
-                predicted_gt_image_batch_t=predicted_gt_image_batch,
-                cond_image_batch=cond_image_batch,
-                alpha_t=torch.tensor(inference_noise_schedule.alphas[t], device=cond_image_batch.device),
-                gamma_t=torch.tensor(inference_noise_schedule.gammas[t], device=cond_image_batch.device)
-            )*mask + cond_image_batch*(1-mask) # apply masking
+            predicted_gt_image_batch = torch.where(
+                mask_b,
+                # under autocast the refinement step may return half precision, so match the conditioned image
+                self.refinement_step(
+                    predicted_gt_image_batch_t=predicted_gt_image_batch,
+                    cond_image_batch=cond_image_batch,
+                    alpha_t=alphas[t],
+                    gamma_t=gammas[t]
+                ).to(cond_image_batch.dtype),
+                cond_image_batch
+            ) # apply masking
         return predicted_gt_image_batch
 
 
@@ -40,7 +49,7 @@ class Palette(networks.guided_diffusion.UNet, Diffusion):
         noise_prediction = super().forward(torch.cat([cond_image_batch, noisy_image_batch], dim=1), gamma)
         return noise_prediction
     
-    @torch.no_grad()
+    @torch.inference_mode()
     def refinement_step(self, predicted_gt_image_batch_t: torch.Tensor, cond_image_batch: torch.Tensor, alpha_t: torch.Tensor, gamma_t: torch.Tensor):
         ### use paper Saharia et al. directly
         ## prepare
@@ -55,7 +64,7 @@ class Palette(networks.guided_diffusion.UNet, Diffusion):
 
         ## generate a sample image, by sampling from Gaussian distribution N(mu_theta, sigma_theta^2)
         # generate new Gaussian noise from a Z-dist
-        epsilon = torch.randn_like(predicted_gt_image_batch_t)
-        # scale using X = sigma*Z + mu; output is refined prediction
-        predicted_gt_image_batch_tm1 = sigma_t*epsilon + mu_t
+        epsilon = torch.empty_like(predicted_gt_image_batch_t).normal_()
+        # scale using X = sigma*Z + mu in place, reusing the noise allocation; output is refined prediction
+        predicted_gt_image_batch_tm1 = epsilon.mul_(sigma_t).add_(mu_t)
         return predicted_gt_image_batch_tm1
\ No newline at end of file
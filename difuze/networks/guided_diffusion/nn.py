@@ -129,8 +129,8 @@ def gamma_embedding(gammas, dim, max_period=10000):
     """
     half = dim // 2
     freqs = torch.exp(
-        -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
-    ).to(device=gammas.device)
+        -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32, device=gammas.device) / half
+    )
     args = gammas[:, None].to(torch.get_default_dtype()) * freqs[None]
     embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
     if dim % 2:
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 def load_flist(path: str) -> np.ndarray:
     return np.loadtxt(path, dtype=int)
@@ -9,7 +10,18 @@ class NoiseSchedule:
         self.betas = spacing_function(beta_min, beta_max, T_steps)
         self.alphas = 1.-self.betas
         self.gammas = np.cumprod(self.alphas, axis=0)
+        self._device_tensors = {}
     def __getitem__(self, index):
         return self.alphas(index)
     def __len__(self):
         return self.T_steps
+    def device_tensors(self, device) -> tuple[torch.Tensor, torch.Tensor]:
+        # return the alphas and gammas as tensors on the device, copying them there only on first use
+        # they are kept in double precision, since 1-alpha is badly rounded in float32 for small betas
+        device = torch.device(device)
+        if device not in self._device_tensors:
+            self._device_tensors[device] = (
+                torch.as_tensor(self.alphas, dtype=torch.float64, device=device),
+                torch.as_tensor(self.gammas, dtype=torch.float64, device=device)
+            )
+        return self._device_tensors[device]
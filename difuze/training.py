@@ -1,7 +1,7 @@
 import torch
 import torch.utils.data
 import numpy as np
-import random
+import os
 import tqdm
 
 from collections import OrderedDict
@@ -12,6 +12,7 @@ from . import log
 from . import support
 from . import models
 from . import metrics
+from . import data
 
 # a class containing the main algorithms for training any diffusion model
 class TrainingFramework:
@@ -30,10 +31,16 @@ class TrainingFramework:
         data_logger: log.DataLogger,
 
         state_dict_to_load: dict = None,
-        metric_scheduler = None
+        metric_scheduler = None,
+        use_amp: bool = False,
+        gradient_accumulation_steps: int = 1,
+        compile_model: bool = False,
+        channels_last: bool = False,
+        cuda_graph: bool = False
     ):
         ## properties specified as arguments
         self.device = device
+        self._device_type = torch.device(device).type
         self.model = model.to(device)
         self.optimizer = optimizer
         self.loss_scheduler = loss_scheduler
@@ -46,6 +53,48 @@ class TrainingFramework:
         self.data_logger = data_logger
 
         self.metric_scheduler = metric_scheduler
+        self.use_amp = use_amp
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        if self.gradient_accumulation_steps < 1:
+            raise ValueError('gradient_accumulation_steps must be at least 1')
+        self.compile_model = compile_model
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.cuda_graph = cuda_graph
+
+        ## the CUDA graph replays fixed buffers, so it needs a CUDA device, static shapes, and no second graph from the compiler
+        if self.cuda_graph:
+            if self._device_type != 'cuda':
+                raise ValueError('CUDA graph capture requires a CUDA device')
+            if self.compile_model:
+                raise ValueError('CUDA graph capture cannot be combined with compile_model, which already uses CUDA graphs')
+            if not self.training_dataloader.drop_last:
+                raise ValueError('CUDA graph capture requires a training dataloader with drop_last=True')
+            # the graphed backward hands out views of its static gradient buffers, which the next replay overwrites
+            if self.gradient_accumulation_steps != 1:
+                raise ValueError('CUDA graph capture cannot be combined with gradient accumulation')
+        self._graph_captured = False
+
+        ## mixed precision: autocast the forward pass and scale the loss to avoid FP16 gradient underflow
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+
+        ## store convolution weights as NHWC if requested, enabling the faster channels_last cuDNN kernels
+        if channels_last:
+            self.model = self.model.to(memory_format=self.memory_format)
+
+        ## compile the forward pass, which is shared by training and by the refinement step during sampling
+        # the bound method is replaced rather than wrapping the module, so that state dict keys are unchanged
+        if self.compile_model:
+            self.model.forward = torch.compile(self.model.forward, mode='reduce-overhead')
+
+        ## the noise schedule is fixed, so keep its square roots on the device rather than recomputing each step
+        # compute the coefficients in double precision, then cast them so they do not promote the images to float64
+        _, training_gammas = self.training_noise_schedule.device_tensors(device)
+        self._training_gammas = training_gammas.float()
+        self._training_sqrt_gammas = training_gammas.sqrt().float()
+        self._training_sqrt_one_minus_gammas = (1-training_gammas).sqrt().float()
+
+        ## the training noise field is refilled in place each step; it is allocated on the first batch
+        self._noise_field = None
 
         self.epoch_number = 0
 
@@ -58,16 +107,30 @@ class TrainingFramework:
             " --- optimizer: {optim}",
             " --- initial learning rate: {lr}",
             " --- batch size: {batch}",
+            " --- gradient accumulation steps: {accum}",
+            " --- mixed precision: {amp}",
+            " --- compiled model: {compiled}",
+            " --- CUDA graph: {cuda_graph}",
+            " --- memory format: {memory_format}",
             ":: end configuration summary"
             )).format(
                 hostname = gethostname(),
                 loss_fn = self.loss_function.__class__.__name__,
                 optim = self.optimizer.__class__.__name__,
                 lr = self.optimizer.param_groups[-1]['lr'],
-                batch = self.training_dataloader.batch_size
+                batch = self.training_dataloader.batch_size,
+                accum = self.gradient_accumulation_steps,
+                amp = self.use_amp,
+                compiled = self.compile_model,
+                cuda_graph = self.cuda_graph,
+                memory_format = self.memory_format
             )
         )
 
+        ## warn about dataloader configurations which will slow down training
+        self._check_dataloader('training', self.training_dataloader)
+        self._check_dataloader('validation', self.validation_dataloader)
+
         if state_dict_to_load is not None:
             self.data_logger.message('Loading state from dict...')
             self.state = state_dict_to_load
@@ -75,10 +138,11 @@ class TrainingFramework:
         self._initial_learning_rate = self.optimizer.param_groups[-1]['lr']
 
 
-    def train_single_epoch(self, log_every: int) -> torch.Tensor:
+    def train_single_epoch(self, log_every: int, display_every: int = 20) -> float:
         """Train the neural network over a full iteration of the training dataloader
 
         log_every: the number of iterations between each logging event
+        display_every: the number of iterations between each update of the loss shown on the progress bar
         """
 
         # update the epoch number
@@ -88,28 +152,43 @@ class TrainingFramework:
         self.data_logger.message('This is epoch '+str(self.epoch_number), also_print=True)
         self.data_logger.message('Beginning training...', also_print=True)
 
-        # zero loss counters
-        running_loss = 0.
-        current_loss = 0.
+        # zero loss counters, keeping the running total on the device so that reading it does not sync every iteration
+        running_loss = torch.zeros((), device=self.device)
         # loop over the training data, showing tqdm progress bar and tracking the index
         # use tqdm to show a progress bar, to which we can affix the current loss rate
-        pbar = tqdm.tqdm(self.training_dataloader, postfix='current learning rate: --------, current loss: ------')
+        # batches are copied to the device one iteration ahead by the prefetcher
+        pbar = tqdm.tqdm(data.CudaPrefetcher(self.training_dataloader, self.device), postfix='current learning rate: --------, current loss: ------')
+        # start the epoch with no accumulated gradients
+        self.optimizer.zero_grad(set_to_none=True)
         # using zero indexing is annoying for mean calc, so start from 1
-        for i, data in enumerate(pbar, start=1):
+        for i, batch in enumerate(pbar, start=1):
             # extract the images from the loaded data
-            gt_image_batch, cond_image_batch, mask, actual_index = data
+            gt_image_batch, cond_image_batch, mask, actual_index = batch
+
+            # find the size of the accumulation group this batch belongs to; the final group of an epoch may be partial
+            group_start = self.gradient_accumulation_steps*((i-1)//self.gradient_accumulation_steps)
+            group_size = min(self.gradient_accumulation_steps, len(self.training_dataloader) - group_start)
 
             # add the loss to the cumulative total
-            current_loss = self.train_one_batch(gt_image_batch.to(self.device), cond_image_batch.to(self.device), mask.to(self.device))
+            current_loss = self.train_one_batch(gt_image_batch, cond_image_batch, mask, group_size)
 
-            # display the current learning rate and loss on the progress bat
-            pbar.set_postfix_str('current learning rate: {:.2e}, current loss: {:.4f}'.format(float(self.optimizer.param_groups[-1]['lr']), float(current_loss)))
+            # check if we have accumulated gradients over enough batches to step
+            if i % self.gradient_accumulation_steps == 0:
+                # adjust learning weights, skipping the step if the scaled gradients overflowed
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                # reset optimizer gradients
+                self.optimizer.zero_grad(set_to_none=True)
+
+            # display the current learning rate and loss on the progress bar; reading the loss forces a sync, so do this sparingly
+            if i % display_every == 0:
+                pbar.set_postfix_str('current learning rate: {:.2e}, current loss: {:.4f}'.format(float(self.optimizer.param_groups[-1]['lr']), current_loss.item()))
 
             running_loss += current_loss
             # check if we are at a logging iteration
             if i % log_every == 0:
-                # find the mean loss over the past logging group
-                mean_loss = running_loss/log_every
+                # find the mean loss over the past logging group, copying it to the host once
+                mean_loss = (running_loss/log_every).item()
 
                 # determine the global index for logging purposes - equal to the number of images seen by the model
                 global_index = ((self.epoch_number-1)*len(self.training_dataloader) + i)*self.training_dataloader.batch_size
@@ -127,41 +206,59 @@ class TrainingFramework:
                 )
 
                 # zero the running counter
-                running_loss = 0.
+                running_loss.zero_()
+
+        # step on the final, partial accumulation group rather than discarding its gradients
+        if len(self.training_dataloader) % self.gradient_accumulation_steps != 0:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
 
         # return the most recent loss
         return mean_loss
 
 
-    def train_one_batch(self, gt_image_batch: torch.Tensor, cond_image_batch: torch.Tensor, mask: torch.BoolTensor) -> torch.Tensor:
-        """Train the neural network over a single batch of images
+    def train_one_batch(self, gt_image_batch: torch.Tensor, cond_image_batch: torch.Tensor, mask: torch.BoolTensor, accumulation_group_size: int = 1) -> torch.Tensor:
+        """Accumulate gradients over a single batch of images; the optimizer is stepped by train_single_epoch
         
         gt_image_batch: the batch of ground truth images
         cond_image_batch: the batch of conditioned images
         mask: a boolean array of pixels to ignore in predictions (NOT YET IMPLEMENTED)
+        accumulation_group_size: the number of batches whose gradients are accumulated before the next optimizer step
         """
 
         # place the model into training mode
         self.model.train()
-        # reset optimizer gradients
-        self.optimizer.zero_grad()
-        # randomly pick t, and sample the corresponding gamma
-        t = random.randrange(len(self.training_noise_schedule))
-        gamma = torch.tensor(self.training_noise_schedule.gammas[t], device=self.device)
-        # generate N(0,1) noise field
-        noise_field = torch.randn_like(gt_image_batch, device=self.device)
-        # add noise to the gt_image_batch at an appropriate level
-        noisy_image_batch = torch.sqrt(gamma)*gt_image_batch + torch.sqrt(1-gamma)*noise_field
-        # return predict the noise field using the nn
-        predicted_noise_field = self.model(cond_image_batch, noisy_image_batch, gamma)
-        # calculate loss
-        loss = self.loss_function(noise_field, predicted_noise_field)
-        loss.backward()
-        # adjust learning weights
-        self.optimizer.step()
-        return loss
-
-    @torch.no_grad()
+        # match the memory format of the model
+        gt_image_batch = gt_image_batch.contiguous(memory_format=self.memory_format)
+        cond_image_batch = cond_image_batch.contiguous(memory_format=self.memory_format)
+        # randomly pick t for each image in the batch, and sample the corresponding gammas
+        t = torch.randint(len(self.training_noise_schedule), (len(gt_image_batch),), device=self.device)
+        gamma = self._training_gammas[t]
+        # shape the noise coefficients to broadcast over each image
+        sqrt_gamma = self._training_sqrt_gammas[t].view(-1, 1, 1, 1)
+        sqrt_one_minus_gamma = self._training_sqrt_one_minus_gammas[t].view(-1, 1, 1, 1)
+        # generate N(0,1) noise field, reallocating the buffer only if the batch shape changes
+        if self._noise_field is None or self._noise_field.shape != gt_image_batch.shape:
+            self._noise_field = torch.empty_like(gt_image_batch)
+        noise_field = self._noise_field.normal_()
+        # run the forward pass in reduced precision if AMP is enabled
+        with self._autocast():
+            # add noise to the gt_image_batch at an appropriate level, using a single allocation and a fused multiply-add
+            noisy_image_batch = torch.mul(gt_image_batch, sqrt_gamma).addcmul_(noise_field, sqrt_one_minus_gamma)
+            # capture the forward and backward passes of the model as CUDA graphs on the first batch
+            if self.cuda_graph and not self._graph_captured:
+                self._capture_graph(cond_image_batch, noisy_image_batch, gamma)
+            # return predict the noise field using the nn
+            predicted_noise_field = self.model(cond_image_batch, noisy_image_batch, gamma)
+            # calculate loss
+            loss = self.loss_function(noise_field, predicted_noise_field)
+        # backpropagate the (scaled) loss, averaging over the accumulation group
+        self.scaler.scale(loss/accumulation_group_size).backward()
+        # return the loss without its graph, leaving it on the device
+        return loss.detach()
+
+    @torch.inference_mode()
     def evaluate_single_epoch(self) -> float:
         """Sample from the neural network over a single iteration of the validation dataloader, and run metrics
 
@@ -170,28 +267,38 @@ class TrainingFramework:
         # inform the user that validation is about to commence
         self.data_logger.message('This is an validation epoch. Beginning evalution...', also_print=True)
         
-        # make ordered dict to store lists of metric results
-        all_metric_results = OrderedDict(
-            (metric.name, []) for metric in self.validation_metrics
+        # make ordered dicts to store running totals of metric results on the device, to avoid syncing every batch
+        metric_sums = OrderedDict(
+            (metric.name, torch.zeros((), device=self.device)) for metric in self.validation_metrics
+        )
+        metric_counts = OrderedDict(
+            (metric.name, torch.zeros((), device=self.device)) for metric in self.validation_metrics
         )
         # loop over the validation data, showing tqdm progress bar and tracking the index
-        for i, data in enumerate(tqdm.tqdm(self.validation_dataloader)):
-            gt_image_batch, cond_image_batch, mask, actual_index = data
+        # batches are copied to the device one iteration ahead by the prefetcher
+        for i, batch in enumerate(tqdm.tqdm(data.CudaPrefetcher(self.validation_dataloader, self.device))):
+            gt_image_batch, cond_image_batch, mask, actual_index = batch
             # get the current metric results
-            predicted_gt_image_batch, metric_results = self.evaluate_one_batch(gt_image_batch.to(self.device), cond_image_batch.to(self.device), mask.to(self.device))
-            # loop over all metrics, and add the result for each image in the batch to the list for this epoch
+            predicted_gt_image_batch, metric_results = self.evaluate_one_batch(gt_image_batch, cond_image_batch, mask)
+            # loop over all metrics, and add the results for the batch to the totals, ignoring any stray NaNs
             for key in metric_results:
-                all_metric_results[key].extend(metric_results[key])
-        # create a new OrderedDict to store the mean metric results, by dividing through by the length of the dataloader
-        mean_metric_results = OrderedDict(
-            # use nanmean to avoid polluting the mean with any stray NaNs
-            (key, np.nanmean(all_metric_results[key])) for key in metric_results
-        )
+                metric_sums[key] += torch.nansum(metric_results[key])
+                metric_counts[key] += (~torch.isnan(metric_results[key])).sum()
+            # keep only the FINAL visual from the FINAL batch for logging, so the rest of the batch can be freed
+            if i == len(self.validation_dataloader)-1:
+                final_visuals = OrderedDict((
+                    ('{:0>8d}_Cond'.format(actual_index[-1]), cond_image_batch[-1].squeeze().clone()),
+                    ('{:0>8d}_Pred'.format(actual_index[-1]), predicted_gt_image_batch[-1].squeeze().clone()),
+                    ('{:0>8d}_GT'.format(actual_index[-1]), gt_image_batch[-1].squeeze().clone())
+                ))
+            del batch, gt_image_batch, cond_image_batch, mask, predicted_gt_image_batch, metric_results
+        # create a new OrderedDict to store the mean metric results, reducing all metrics at once and copying to the host a single time
+        mean_values = (torch.stack(tuple(metric_sums.values()))/torch.stack(tuple(metric_counts.values()))).tolist() if metric_sums else []
+        mean_metric_results = OrderedDict(zip(metric_sums, mean_values))
 
         # calculate an RMS score
-        rms_metrics = np.sqrt(np.mean(tuple(
-            mean_metric_results[metric_name]**2 for metric_name in mean_metric_results
-        )))
+        metric_values = np.fromiter(mean_metric_results.values(), dtype=np.float64, count=len(mean_metric_results))
+        rms_metrics = float(np.sqrt(np.mean(metric_values*metric_values)))
         mean_metric_results['All_Metrics_RMS'] = rms_metrics
 
         self.data_logger.message('Metric results:', also_print=True)
@@ -210,11 +317,6 @@ class TrainingFramework:
             )
         
         # log the FINAL visual from the FINAL batch
-        final_visuals = OrderedDict((
-            ('{:0>8d}_Cond'.format(actual_index[-1]), cond_image_batch[-1].squeeze()),
-            ('{:0>8d}_Pred'.format(actual_index[-1]), predicted_gt_image_batch[-1].squeeze()),
-            ('{:0>8d}_GT'.format(actual_index[-1]), gt_image_batch[-1].squeeze())
-        ))
         for visual_name in final_visuals:
             self.data_logger.tensor(
                 series_name = 'validation/Visual/',
@@ -226,8 +328,8 @@ class TrainingFramework:
         # return the RMS score for determining the best epoch
         return rms_metrics
     
-    @torch.no_grad()
-    def evaluate_one_batch(self, gt_image_batch: torch.Tensor, cond_image_batch: torch.Tensor, mask: torch.BoolTensor) -> tuple[torch.Tensor, OrderedDict[str, tuple[float]]]:
+    @torch.inference_mode()
+    def evaluate_one_batch(self, gt_image_batch: torch.Tensor, cond_image_batch: torch.Tensor, mask: torch.BoolTensor) -> tuple[torch.Tensor, OrderedDict[str, torch.Tensor]]:
         """Sample from the neural network over a single batch of images, and run metrics
         
         gt_image_batch: the batch of ground truth images
@@ -237,19 +339,68 @@ class TrainingFramework:
         
         # place the model into validation mode
         self.model.eval()
+        # match the memory format of the model
+        cond_image_batch = cond_image_batch.contiguous(memory_format=self.memory_format)
         # carry out inference to predict the ground truth
-        predicted_gt_image_batch = self.model.infer_one_batch(cond_image_batch, mask, self.inference_noise_schedule)
-        # run validation metrics on the image
+        with self._autocast():
+            predicted_gt_image_batch = self.model.infer_one_batch(cond_image_batch, mask, self.inference_noise_schedule)
+        # run validation metrics on the image, collecting the results for each metric into a tensor on the device
         metric_results = OrderedDict(
             (
                 metric.name,
-                [metric(
+                self._collect_metric_results([metric(
                     predicted_gt_image=predicted_gt_image_batch[i].squeeze(),
                     gt_image=gt_image_batch[i].squeeze()
-                ) for i in range(len(gt_image_batch))]
+                ) for i in range(len(gt_image_batch))])
             ) for metric in self.validation_metrics
         )
         return predicted_gt_image_batch, metric_results
+
+    def _collect_metric_results(self, results: list) -> torch.Tensor:
+        # metrics which already return device tensors are stacked where they are
+        if all(isinstance(result, torch.Tensor) for result in results):
+            return torch.stack(results).to(device=self.device, dtype=torch.float32)
+        # otherwise build the batch on the host and copy it to the device once
+        return torch.tensor([float(result) for result in results], dtype=torch.float32).to(self.device, non_blocking=True)
+
+    def _check_dataloader(self, name: str, dataloader: torch.utils.data.DataLoader) -> None:
+        # non_blocking host-to-device copies are only asynchronous from page-locked memory
+        if self._device_type == 'cuda' and not dataloader.pin_memory:
+            self.data_logger.message(
+                'WARNING: the {} dataloader does not use pinned memory; set pin_memory=True to overlap transfers with compute'.format(name),
+                also_print=True
+            )
+        # loading in the main process, or respawning workers every epoch, stalls the start of each epoch
+        if dataloader.num_workers < (os.cpu_count() or 1)//2:
+            self.data_logger.message(
+                'WARNING: the {} dataloader uses only {} workers; consider data.make_dataloader for a faster configuration'.format(name, dataloader.num_workers),
+                also_print=True
+            )
+        elif not dataloader.persistent_workers:
+            self.data_logger.message(
+                'WARNING: the {} dataloader does not use persistent workers; set persistent_workers=True to avoid respawning them every epoch'.format(name),
+                also_print=True
+            )
+        # a partial final batch changes the input shapes, forcing the compiled model to recompile
+        if self.compile_model and not dataloader.drop_last:
+            self.data_logger.message(
+                'WARNING: the {} dataloader does not drop its last batch; set drop_last=True to keep input shapes static for the compiled model'.format(name),
+                also_print=True
+            )
+
+    def _capture_graph(self, cond_image_batch: torch.Tensor, noisy_image_batch: torch.Tensor, gamma: torch.Tensor) -> None:
+        # record the model's forward and backward passes once, so each later call is a single graph replay
+        # the model's forward is replaced in place and only used in training mode, so sampling still runs eagerly
+        # the sample inputs become the static input buffers, into which each new batch is copied before replay
+        self.data_logger.message('Capturing CUDA graph of the training forward and backward passes...', also_print=True)
+        sample_args = (cond_image_batch.clone(), noisy_image_batch.clone(), gamma.clone())
+        torch.cuda.make_graphed_callables(self.model, sample_args)
+        self._graph_captured = True
+
+    def _autocast(self) -> torch.autocast:
+        # build an autocast context, which is a no-op unless AMP is enabled
+        # graphed callables cannot use the autocast weight cache, as the cached casts would be freed after capture
+        return torch.autocast(device_type=self._device_type, dtype=torch.float16, enabled=self.use_amp, cache_enabled=not self.cuda_graph)
     
     @property
     def state(self) -> dict:
@@ -265,6 +416,7 @@ class TrainingFramework:
             'best_rms_metrics': self.best_rms_metrics,
             'configuration': {
                 'batch_size': self.training_dataloader.batch_size,
+                'gradient_accumulation_steps': self.gradient_accumulation_steps,
                 'initial_lr': self._initial_learning_rate,
                 'optimizer': self.optimizer.__class__.__name__,
                 'loss_function': self.loss_function.__class__.__name__
@@ -275,6 +427,10 @@ class TrainingFramework:
         if self.metric_scheduler is not None:
             state_dict['metric_scheduler_state_dict'] = self.metric_scheduler.state_dict()
 
+        # add the gradient scaler if mixed precision is in use
+        if self.use_amp:
+            state_dict['scaler_state_dict'] = self.scaler.state_dict()
+
         return state_dict
     
     @state.setter
@@ -286,14 +442,17 @@ class TrainingFramework:
         self.loss_scheduler.load_state_dict(state_dict['loss_scheduler_state_dict'])
         self.recent_rms_metrics = state_dict['recent_rms_metrics']
         self._initial_learning_rate = state_dict['configuration']['initial_lr']
+        if self.use_amp and 'scaler_state_dict' in state_dict:
+            self.scaler.load_state_dict(state_dict['scaler_state_dict'])
     
 
-    def main_training_loop(self, log_every: int = 100, eval_every: int = 1, save_every: int = 1) -> None:
+    def main_training_loop(self, log_every: int = 100, eval_every: int = 1, save_every: int = 1, display_every: int = 20) -> None:
         """Run the training and validation cycle for the model
 
         log_every: the number of training iterations between each logging event
         eval_every: the number of epochs between each validation event
         save_every: the number of epochs between each forced save event; note that a best RMS validation score triggers saving anyway
+        display_every: the number of training iterations between each update of the progress bar loss
         """
 
         # keep track of the epoch number and the best metric score
@@ -303,7 +462,7 @@ class TrainingFramework:
             
 
             # actually run training
-            self.train_single_epoch(log_every)
+            self.train_single_epoch(log_every, display_every)
 
             # keep track of whether we have saved the model this epoch
             saved = False